@@ -1,21 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import validates
 from flask_wtf import FlaskForm
 from flask_bcrypt import Bcrypt
 from wtforms import StringField, PasswordField, SelectField, SubmitField, BooleanField
-from wtforms.validators import DataRequired, Email, Length, EqualTo
+from wtforms.validators import DataRequired, Length, EqualTo
 import os
 import secrets
 import json
-from datetime import datetime
+import functools
+import heapq
+import pickle
+import re
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 from werkzeug.middleware.proxy_fix import ProxyFix
 import unicodedata
 import logging
-import bleach
+import queue
+import atexit
+import threading
+from types import SimpleNamespace
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+import time
 from wtforms.validators import Regexp
 from dotenv import load_dotenv
-from ldap3 import Server, Connection, ALL, NTLM
+from ldap3 import Server, Connection, NONE, NTLM
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.conv import escape_filter_chars
 from flask_wtf.csrf import CSRFProtect
 load_dotenv()
 
@@ -29,16 +43,46 @@ PORT = int(os.environ.get('PORT', 8080))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'query_cache_size': 1200,
+    'pool_pre_ping': True,  # connexion coupée par le serveur pendant une période d'inactivité : remplacée au checkout
+    'pool_recycle': 1800,   # secondes
+}
+if app.config['SQLALCHEMY_DATABASE_URI'] and make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_driver_name() == 'psycopg2':
+    # executemany groupé : INSERT multi-lignes par pages de 1000, execute_batch pour UPDATE/DELETE
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        executemany_mode='values_plus_batch',
+        insertmanyvalues_page_size=1000,
+        executemany_batch_page_size=500
+    )
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 app.config['SESSION_COOKIE_SECURE'] = True
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'   # Protège contre le CSRF (Lax est un bon compromis)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', '12'))
+REDIS_URL = os.environ.get('REDIS_URL')
 LDAP_SERVER = os.environ.get('LDAP_SERVER')
 LDAP_BASE_DN = os.environ.get('LDAP_BASE_DN')
+LDAP_BIND_DN = os.environ.get('LDAP_BIND_DN')
+LDAP_BIND_PASSWORD = os.environ.get('LDAP_BIND_PASSWORD')
+LDAP_TIMEOUT = int(os.environ.get('LDAP_TIMEOUT', '5'))  # secondes, connexion et réponses
+LDAP_POOL_SIZE = int(os.environ.get('LDAP_POOL_SIZE', '4'))  # connexions de service gardées ouvertes
+
+
+# Sessions côté serveur si Redis est configuré : le cookie ne contient plus que l'identifiant de session
+if REDIS_URL:
+    import redis
+    from flask_session import Session
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.Redis.from_url(REDIS_URL)
+    app.config['SESSION_PERMANENT'] = False
+    app.config['SESSION_USE_SIGNER'] = True
+    Session(app)
 
 
 # Initialize extensions
-db = SQLAlchemy(app)
+# Pas d'expiration au commit : les objets déjà chargés restent lisibles sans nouveau SELECT
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
 bcrypt = Bcrypt(app)
 csrf = CSRFProtect(app)
 
@@ -46,11 +90,32 @@ csrf = CSRFProtect(app)
 if not os.path.exists('logs'):
     os.makedirs('logs')
 
-file_handler = logging.FileHandler('logs/app.log', encoding='utf-8', errors='replace')
+# WatchedFileHandler rouvre le fichier après une rotation externe (logrotate),
+# sans que les workers gunicorn ne se marchent dessus
+file_handler = WatchedFileHandler('logs/app.log', encoding='utf-8', errors='replace')
 file_handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
-app.logger.addHandler(file_handler)
+
+# Les requêtes ne font qu'empiler les messages, l'écriture disque se fait dans un thread dédié
+queue_handler = QueueHandler(queue.Queue(-1))
+log_listener = None
+
+def start_log_listener():
+    """Démarre le thread d'écriture des logs du processus courant"""
+    global log_listener
+    # File neuve : après un fork, celle du parent a pu être copiée verrouillée, et son thread n'existe plus
+    queue_handler.queue = queue.Queue(-1)
+    log_listener = QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+
+start_log_listener()
+# Workers gunicorn créés par fork après l'import (--preload) : chacun démarre son propre thread
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=start_log_listener)
+atexit.register(lambda: log_listener.stop())
+
+app.logger.addHandler(queue_handler)
 app.logger.setLevel(logging.INFO)
 
 app.logger.info('Application démarrée')
@@ -59,24 +124,34 @@ app.logger.info('Application démarrée')
 # User Model simplifié
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False, index=True)  # stocké en minuscules
     password_hash = db.Column(db.String(128), nullable=False)
     nom = db.Column(db.String(100), nullable=False)
     prenom = db.Column(db.String(100), nullable=False)
     user_type = db.Column(db.String(20), nullable=False)  # 'etudiant' or 'professeur'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    @validates('email')
+    def normalize_email(self, key, email):
+        # Les recherches se font toujours en minuscules : aucun email ne doit être stocké autrement
+        return email.strip().lower()
+
     def __repr__(self):
         return f'<User {self.email}>'
 
+# Expressions régulières de validation (compilées une seule fois à l'import)
+# Email : points seulement entre deux caractères, labels de domaine commençant et finissant par une lettre ou un chiffre
+EMAIL_RE = re.compile(r'^[\w+\-]+(?:\.[\w+\-]+)*@(?:[^\W_](?:[\w\-]*[^\W_])?\.)+[A-Za-z]{2,}\Z')
+NAME_RE = re.compile(r"^[A-Za-zÀ-ÿ\s'\-]+$")
+
 # Forms simplifiés
 class RegistrationForm(FlaskForm):
     email = StringField(
         'Email', 
         validators=[
             DataRequired(), 
-            Email(message="Adresse email invalide"),
-            Regexp(r'^[\w\.-]+@[\w\.-]+\.\w+$', message="Format d'email invalide")
+            Length(max=120),
+            Regexp(EMAIL_RE, message="Format d'email invalide")
         ]
     )
     nom = StringField(
@@ -84,7 +159,7 @@ class RegistrationForm(FlaskForm):
         validators=[
             DataRequired(), 
             Length(min=2, max=100),
-            Regexp(r"^[A-Za-zÀ-ÿ\s'-]+$", message="Le nom contient des caractères invalides.")
+            Regexp(NAME_RE, message="Le nom contient des caractères invalides.")
         ]
     )
     prenom = StringField(
@@ -92,7 +167,7 @@ class RegistrationForm(FlaskForm):
         validators=[
             DataRequired(), 
             Length(min=2, max=100),
-            Regexp(r"^[A-Za-zÀ-ÿ\s'-]+$", message="Le prénom contient des caractères invalides.")
+            Regexp(NAME_RE, message="Le prénom contient des caractères invalides.")
         ]
     )
     password = PasswordField(
@@ -117,7 +192,9 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField('S\'inscrire')
 
 class LoginForm(FlaskForm):
-    email = StringField('Email', validators=[DataRequired(), Email()])
+    # Pas de contrôle de format : la connexion n'enregistre rien, une adresse inconnue échoue à la recherche
+    # (un format plus strict qu'à l'origine refuserait des comptes LDAP existants)
+    email = StringField('Email', validators=[DataRequired(), Length(max=120)])
     password = PasswordField('Mot de passe', validators=[DataRequired()])
     remember_me = BooleanField('Se souvenir de moi')
     submit = SubmitField('Se connecter')
@@ -126,55 +203,217 @@ class SearchForm(FlaskForm):
     query = StringField('Rechercher un cours', validators=[DataRequired()])
     submit = SubmitField('Rechercher')
 
+# Valeur de password_hash des comptes créés depuis LDAP : ne correspond à aucun hash bcrypt
+LDAP_PASSWORD_HASH = '!ldap!'
+
 # Helper functions
+def is_local_password_hash(password_hash):
+    """Vrai si le hash est un hash bcrypt ($2a$, $2b$...), donc vérifiable localement"""
+    return password_hash.startswith('$2')
+
 def is_logged_in():
-    return 'user_id' in session
+    return session.get('user_id') is not None
 
-def get_current_user():
-    if is_logged_in():
-        return User.query.get(session['user_id'])
-    return None
+# Marqueur « utilisateur pas encore résolu » pour la requête en cours
+_UNRESOLVED = object()
+
+@app.before_request
+def reset_current_user():
+    g._current_user = _UNRESOLVED
+
+def _session_user(user):
+    """Champs de l'utilisateur gardés en session, avec leur date de lecture en base"""
+    data = {'id': user.id, 't': user.user_type, 'p': user.prenom, 'at': int(time.time())}
+    if REDIS_URL:
+        # Le cookie signé n'est pas chiffré : l'email n'y figure que si la session est stockée côté serveur
+        data['e'] = user.email
+    return data
+
+def reset_session():
+    """Vide la session ; avec Redis, change aussi son identifiant et supprime l'ancienne entrée"""
+    session.clear()
+    if REDIS_URL:
+        # Flask-Session garde tout identifiant signé envoyé par le client, même inconnu de Redis :
+        # sans rotation, un identifiant imposé avant la connexion (fixation de session) resterait valide après
+        interface = app.session_interface
+        interface.redis.delete(interface.key_prefix + session.sid)
+        session.sid = interface._generate_sid()
+
+def remember_user(user):
+    """Ouvre la session de l'utilisateur et y garde les champs lus par les vues et les templates"""
+    reset_session()
+    session['user_id'] = user.id
+    session['u'] = _session_user(user)
+
+def _load_session_user():
+    """Relit l'utilisateur de la session en base ; un compte supprimé met fin à la session"""
+    user_id = session.get('user_id')
+    user = db.session.get(User, user_id) if user_id is not None else None
+    if user is not None:
+        session['u'] = _session_user(user)
+    elif user_id is not None:
+        session.pop('user_id')
+        session.pop('u', None)
+    return user
+
+def get_current_user(fresh=False):
+    """Retourne l'utilisateur connecté, lu depuis la session ; la base n'est interrogée que si
+    ces informations ont plus de PERMANENT_SESSION_LIFETIME, ou si fresh est vrai"""
+    user = g._current_user
+    if user is _UNRESOLVED or (fresh and not isinstance(user, User)):
+        cached = session.get('u')
+        max_age = app.permanent_session_lifetime.total_seconds()
+        if not fresh and cached is not None and time.time() - cached.get('at', 0) < max_age:
+            # Un changement de rôle ou une suppression en base s'applique au plus tard après max_age
+            user = SimpleNamespace(id=cached['id'], email=cached.get('e'), user_type=cached['t'], prenom=cached['p'])
+        else:
+            user = _load_session_user()
+        g._current_user = user
+    return user
+
+def user_label(user):
+    """Désignation de l'utilisateur dans les logs (l'email n'est en session qu'avec Redis)"""
+    return user.email or f"utilisateur #{user.id}"
+
+@app.context_processor
+def inject_current_user():
+    return {'current_user': get_current_user()}
+
+def get_user_by_email(email):
+    """Recherche un utilisateur par email (requête compilée mise en cache par SQLAlchemy)"""
+    return db.session.execute(select(User).where(User.email == email)).scalar_one_or_none()
+
+COURSES_FILE = os.path.join(os.path.dirname(__file__), 'static', 'courses.json')
+# Index précalculé par build_index.py (hors de static/ : il n'a pas à être servi)
+COURSES_INDEX_FILE = os.path.join(app.instance_path, 'courses.idx.pkl')
+
+# Cours et index de recherche en mémoire, rechargés uniquement si le fichier JSON est modifié
+_courses_cache = {'mtime': 0, 'data': [], 'index': {'words': {}, 'trigrams': {}}}
 
 def load_courses():
-    """Charge les cours depuis le fichier JSON"""
+    """Charge les cours depuis le fichier JSON (mis en cache tant que le fichier ne change pas)"""
+    global _courses_cache
     try:
-        courses_file = os.path.join(os.path.dirname(__file__), 'static', 'courses.json')
-        with open(courses_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get('courses', [])
+        mtime = os.stat(COURSES_FILE).st_mtime
+        if mtime == _courses_cache['mtime']:
+            return _courses_cache['data']
+
+        courses, index = None, None
+        if os.path.exists(COURSES_INDEX_FILE) and os.stat(COURSES_INDEX_FILE).st_mtime >= mtime:
+            try:
+                with open(COURSES_INDEX_FILE, 'rb') as f:
+                    version, courses, index = pickle.load(f)
+                if version != SEARCH_INDEX_VERSION:
+                    app.logger.warning("Index des cours d'une autre version, relecture du JSON")
+                    courses, index = None, None
+            except Exception as e:
+                app.logger.warning(f"Index des cours illisible, relecture du JSON : {e}")
+        if courses is None:
+            courses, index = read_courses_file()
+
+        _courses_cache = {'mtime': mtime, 'data': courses, 'index': index}
+        _search_normalized.cache_clear()
+        return courses
     except FileNotFoundError:
-        print("Erreur : Fichier courses.json introuvable.")
-        return []
+        app.logger.error("Erreur : Fichier courses.json introuvable.")
     except json.JSONDecodeError:
-        print("Erreur lors du parsing du fichier JSON.")
-        return []
+        app.logger.error("Erreur lors du parsing du fichier JSON.")
     except Exception as e:
-        print(f"Erreur inconnue lors du chargement des cours : {e}")
-        return []
+        app.logger.error(f"Erreur inconnue lors du chargement des cours : {e}")
+
+    # En cas d'erreur : catalogue vide, nouvelle tentative au prochain appel
+    _courses_cache = {'mtime': 0, 'data': [], 'index': {'words': {}, 'trigrams': {}}}
+    return []
+
+
+
+# Connexions LDAP : un seul objet Server (sans téléchargement du schéma) et un pool borné
+# de connexions de service, gardées ouvertes d'une requête à l'autre
+_ldap_server = None
+_ldap_lock = threading.Lock()
+_ldap_pool = queue.LifoQueue(maxsize=LDAP_POOL_SIZE)  # connexions libres
+
+def get_ldap_server():
+    global _ldap_server
+    with _ldap_lock:
+        if _ldap_server is None:
+            _ldap_server = Server(LDAP_SERVER, get_info=NONE, connect_timeout=LDAP_TIMEOUT)
+        return _ldap_server
+
+def _open_search_conn():
+    return Connection(
+        get_ldap_server(),
+        user=LDAP_BIND_DN,
+        password=LDAP_BIND_PASSWORD,
+        auto_bind=True,
+        receive_timeout=LDAP_TIMEOUT
+    )
 
+def _close_ldap_conn(conn):
+    try:
+        conn.unbind()
+    except Exception:
+        pass
 
+def _acquire_search_conn():
+    """Prend une connexion de service libre (les connexions fermées sont écartées), ou en ouvre une"""
+    while True:
+        try:
+            conn = _ldap_pool.get_nowait()
+        except queue.Empty:
+            return _open_search_conn()
+        if not conn.closed:
+            return conn
+
+def _release_search_conn(conn):
+    """Rend la connexion au pool, ou la ferme s'il est plein"""
+    try:
+        _ldap_pool.put_nowait(conn)
+    except queue.Full:
+        _close_ldap_conn(conn)
 
-def ldap_find_user_dn(email):
+def ldap_search(**kwargs):
+    """Recherche avec une connexion de service, en se reconnectant une fois si le serveur l'a fermée"""
+    conn = _acquire_search_conn()
     try:
-        server = Server(os.environ.get('LDAP_SERVER'), get_info=ALL)
-        conn = Connection(
-            server,
-            user=os.environ.get('LDAP_BIND_DN'),
-            password=os.environ.get('LDAP_BIND_PASSWORD'),
-            auto_bind=True
-        )
+        try:
+            conn.search(**kwargs)
+        except LDAPException:
+            _close_ldap_conn(conn)
+            conn = None
+            conn = _open_search_conn()
+            conn.search(**kwargs)
+        entries = conn.entries
+    except Exception:
+        if conn is not None:
+            _close_ldap_conn(conn)
+        raise
+    _release_search_conn(conn)
+    return entries
+
+@atexit.register
+def close_ldap_connections():
+    while True:
+        try:
+            conn = _ldap_pool.get_nowait()
+        except queue.Empty:
+            break
+        _close_ldap_conn(conn)
 
-        search_filter = f"(mail={email})"
-        conn.search(
-            search_base=os.environ.get('LDAP_BASE_DN'),
-            search_filter=search_filter,
-            attributes=['distinguishedName', 'cn', 'mail']
+
+def ldap_find_user(email):
+    """Recherche l'utilisateur par email : une seule requête ramène son DN et ses attributs de nom"""
+    try:
+        entries = ldap_search(
+            search_base=LDAP_BASE_DN,
+            search_filter=f"(mail={escape_filter_chars(email)})",
+            attributes=['cn', 'sn', 'givenName', 'mail']
         )
 
-        if conn.entries:
-            user_dn = conn.entries[0].entry_dn
-            app.logger.info(f"DN trouvé pour {email} : {user_dn}")
-            return user_dn
+        if entries:
+            entry = entries[0]
+            app.logger.info(f"DN trouvé pour {email} : {entry.entry_dn}")
+            return entry
         else:
             app.logger.warning(f"Aucun DN trouvé pour {email} en LDAP.")
             return None
@@ -185,119 +424,183 @@ def ldap_find_user_dn(email):
 
 def ldap_authenticate(user_dn, password):
     try:
-        server = Server(os.environ.get('LDAP_SERVER'), get_info=ALL)
-        conn = Connection(server, user=user_dn, password=password, auto_bind=True)
-        return conn.bound
+        # Bind éphémère avec le DN de l'utilisateur : seul moyen de vérifier son mot de passe.
+        # Aucune recherche n'y est faite, le contrôle des noms d'attributs est donc inutile
+        # (la connexion de service le garde : c'est lui qui décode les valeurs en texte)
+        conn = Connection(get_ldap_server(), user=user_dn, password=password, auto_bind=True, receive_timeout=LDAP_TIMEOUT,
+                          check_names=False)
+        bound = conn.bound
+        conn.unbind()
+        return bound
     except Exception as e:
         app.logger.warning(f"Erreur lors de l'authentification LDAP avec le DN {user_dn} : {e}")
         return False
 
-def ldap_get_user_info(user_dn):
+def ldap_get_user_info(entry):
+    """Extrait nom et prénom d'une entrée LDAP déjà récupérée (sans nouvelle requête)"""
     try:
-        server = Server(os.environ.get('LDAP_SERVER'), get_info=ALL)
-        conn = Connection(
-            server,
-            user=os.environ.get('LDAP_BIND_DN'),
-            password=os.environ.get('LDAP_BIND_PASSWORD'),
-            auto_bind=True
-        )
-
-        conn.search(
-            search_base=user_dn,
-            search_filter='(objectClass=person)',
-            attributes=['givenName', 'sn', 'cn']
-        )
-
-        if conn.entries:
-            entry = conn.entries[0]
-
-            nom = entry.sn.value if 'sn' in entry and entry.sn.value else None
-            prenom = entry.givenName.value if 'givenName' in entry and entry.givenName.value else None
-
-            if not nom or not prenom:
-                cn = entry.cn.value if 'cn' in entry else None
-                if cn:
-                    parts = cn.strip().split(' ', 1)
-                    if len(parts) == 2:
-                        prenom = prenom or parts[0]
-                        nom = nom or parts[1]
-                    else:
-                        prenom = prenom or parts[0]
-                        nom = nom or "NomInconnu"
+        nom = entry.sn.value if 'sn' in entry and entry.sn.value else None
+        prenom = entry.givenName.value if 'givenName' in entry and entry.givenName.value else None
+
+        if not nom or not prenom:
+            cn = entry.cn.value if 'cn' in entry else None
+            if cn:
+                parts = cn.strip().split(' ', 1)
+                if len(parts) == 2:
+                    prenom = prenom or parts[0]
+                    nom = nom or parts[1]
+                else:
+                    prenom = prenom or parts[0]
+                    nom = nom or "NomInconnu"
 
-            # Fallback final si toujours rien
-            nom = nom or "NomInconnu"
-            prenom = prenom or "PrenomInconnu"
+        # Fallback final si toujours rien
+        nom = nom or "NomInconnu"
+        prenom = prenom or "PrenomInconnu"
 
-            app.logger.info(f"Infos LDAP extraites pour {user_dn} → nom: {nom}, prénom: {prenom}")
-            return {'nom': nom, 'prenom': prenom}
-        else:
-            app.logger.warning(f"Aucune entrée LDAP trouvée pour DN: {user_dn}")
-            return {'nom': 'NomInconnu', 'prenom': 'PrenomInconnu'}
+        app.logger.info(f"Infos LDAP extraites pour {entry.entry_dn} → nom: {nom}, prénom: {prenom}")
+        return {'nom': nom, 'prenom': prenom}
 
     except Exception as e:
-        app.logger.error(f"Erreur extraction infos LDAP pour {user_dn} : {e}")
+        app.logger.error(f"Erreur extraction infos LDAP pour {entry.entry_dn} : {e}")
         return {'nom': 'NomInconnu', 'prenom': 'PrenomInconnu'}
 
+def ldap_login(email, password):
+    """Authentifie en LDAP : retourne (DN ou None si email inconnu, authentifié, entrée LDAP)"""
+    entry = ldap_find_user(email)
+    if entry is None:
+        return None, False, None
+    return entry.entry_dn, ldap_authenticate(entry.entry_dn, password), entry
+
 
 def normalize(text):
     """Supprime les accents et met en minuscules"""
-    return unicodedata.normalize('NFD', text).encode('ascii', 'ignore').decode('utf-8').lower()
+    if text.isascii():
+        # Rien à décomposer : cas le plus fréquent pour les requêtes
+        return text.lower()
+    return unicodedata.normalize('NFD', text).encode('ascii', 'ignore').decode('ascii').lower()
+
+def prepare_course(course):
+    """Précalcule les champs normalisés utilisés par la recherche"""
+    course['_n_title'] = normalize(course.get('title', ''))
+    course['_n_description'] = normalize(course.get('description', ''))
+    course['_n_subject'] = normalize(course.get('subject', ''))
+    course['_n_level'] = normalize(course.get('level', ''))
+    course['_n_keywords'] = [normalize(k) for k in course.get('keywords', [])]
+
+def read_courses_file():
+    """Lit courses.json et prépare les cours et leur index de recherche"""
+    with open(COURSES_FILE, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    courses = data.get('courses', [])
+    for course in courses:
+        prepare_course(course)
+    return courses, build_search_index(courses)
+
+# Poids de chaque champ dans le score de pertinence (le sujet et le niveau comptent ensemble)
+SEARCH_WEIGHTS = {'title': 3, 'description': 2, 'keywords': 4, 'subject': 3}
+
+# Nombre maximal de résultats renvoyés par une recherche
+SEARCH_RESULTS_LIMIT = 50
+
+# Format de l'index (à incrémenter si sa structure change : les fichiers pickle existants sont alors ignorés)
+SEARCH_INDEX_VERSION = 2
+
+def build_search_index(courses):
+    """Construit l'index inversé mot -> {(indice du cours, champ)} et l'index trigramme -> {mots}"""
+    words = defaultdict(set)
+    for idx, course in enumerate(courses):
+        fields = {
+            'title': [course['_n_title']],
+            'description': [course['_n_description']],
+            'keywords': course['_n_keywords'],
+            'subject': [course['_n_subject'], course['_n_level']],
+        }
+        for field, texts in fields.items():
+            for text in texts:
+                for token in text.split():
+                    words[token].add((idx, field))
+
+    trigrams = defaultdict(set)
+    for token in words:
+        for i in range(len(token) - 2):
+            trigrams[token[i:i + 3]].add(token)
+
+    return {'words': dict(words), 'trigrams': dict(trigrams)}
+
+def matching_tokens(word, index):
+    """Mots indexés contenant `word`, présélectionnés par leurs trigrammes communs"""
+    if len(word) < 3:
+        return [token for token in index['words'] if word in token]
+
+    buckets = sorted((index['trigrams'].get(word[i:i + 3], ()) for i in range(len(word) - 2)), key=len)
+    candidates = set(buckets[0]).intersection(*buckets[1:])
+    return [token for token in candidates if word in token]
 
 def search_courses(query):
     """Recherche intelligente dans les cours"""
     if not query or len(query.strip()) < 2:
         return []
 
-    courses = load_courses()
-    query_words = normalize(query).split()
+    load_courses()
+    return list(_search_normalized(tuple(normalize(query).split()), _courses_cache['mtime']))
+
+# Cache des requêtes fréquentes ; mtime identifie la version du catalogue.
+# Les dictionnaires retournés sont partagés entre les requêtes : ne pas les modifier.
+@functools.lru_cache(maxsize=1024)
+def _search_normalized(query_words, mtime):
+    """Calcule les résultats d'une requête déjà normalisée"""
+    cache = _courses_cache
+    courses, index = cache['data'], cache['index']
+    scores = Counter()
+
+    for word in query_words:
+        # Un mot de la requête ne contient pas d'espace : il correspond à un champ
+        # si et seulement s'il est contenu dans l'un de ses mots indexés
+        matches = set()
+        for token in matching_tokens(word, index):
+            matches |= index['words'][token]
+
+        for idx, field in matches:
+            scores[idx] += SEARCH_WEIGHTS[field]
+
+    # Seuls les meilleurs résultats sont triés (à score égal, l'ordre du catalogue est conservé)
+    best = heapq.nlargest(SEARCH_RESULTS_LIMIT, scores.items(), key=lambda item: (item[1], -item[0]))
     results = []
+    for idx, score in best:
+        course_copy = courses[idx].copy()
+        course_copy['relevance_score'] = score
+        results.append(course_copy)
+    return tuple(results)
 
-    for course in courses:
-        score = 0
 
-        # Normalisation de tous les champs utiles
-        title = normalize(course.get('title', ''))
-        description = normalize(course.get('description', ''))
-        subject = normalize(course.get('subject', ''))
-        level = normalize(course.get('level', ''))
-        keywords = [normalize(k) for k in course.get('keywords', [])]
+# Chargement des cours au démarrage de chaque worker
+load_courses()
 
-        # Recherche
-        for word in query_words:
-            if word in title:
-                score += 3
-            if word in description:
-                score += 2
-            if any(word in k for k in keywords):
-                score += 4
-            if word in subject or word in level:
-                score += 3
 
-        if score > 0:
-            course_copy = course.copy()
-            course_copy['relevance_score'] = score
-            results.append(course_copy)
 
-    return sorted(results, key=lambda x: x['relevance_score'], reverse=True)
+# Pages d'erreur statiques (indépendantes de l'utilisateur) : rendues une seule fois
+_error_pages = {}
 
+def render_error_page(template):
+    page = _error_pages.get(template)
+    if page is None:
+        # Rendu direct par Jinja : pas de context processor (ni de requête SQL) sur le chemin d'erreur
+        page = _error_pages[template] = app.jinja_env.get_template(template).render().encode('utf-8')
+    return page
 
 
 # Routes
 @app.route('/')
 def home():
-    current_user = get_current_user()
-    search_form = SearchForm()
-    return render_template('index.html', current_user=current_user, search_form=search_form)
+    # Le formulaire de recherche de l'accueil est écrit à la main dans index.html (jeton CSRF compris)
+    return render_template('index.html')
 
 @app.route('/about')
 def about():
-    current_user = get_current_user()
-    return render_template('about.html', current_user=current_user)
+    return render_template('about.html')
 
 @app.route('/search', methods=['GET', 'POST'])
 def search():
-    current_user = get_current_user()
     form = SearchForm()
     courses = []
     query = ""
@@ -316,21 +619,21 @@ def search():
             courses = search_courses(query)
     
     return render_template('search.html', 
-                         current_user=current_user, 
                          form=form, 
                          courses=courses, 
                          query=query)
 
+# Gestionnaire d'erreurs
 @app.errorhandler(404)
 def not_found_error(error):
-    return render_template('404.html'), 404
+    return Response(render_error_page('404.html'), status=404, mimetype='text/html')
 
 @app.errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     if app.debug:
         return f"<pre>{error}</pre>", 500
-    return render_template('500.html'), 500
+    return Response(render_error_page('500.html'), status=500, mimetype='text/html')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -347,34 +650,34 @@ def register():
             flash("Type d'utilisateur invalide.", 'error')
             return render_template('register.html', form=form)
 
-        email = bleach.clean(form.email.data.lower().strip())
-        existing_user = User.query.filter_by(email=email).first()
+        email = form.email.data.lower().strip()
+        existing_user = get_user_by_email(email)
         if existing_user:
             app.logger.warning(f"Tentative d'inscription avec un email déjà existant : {form.email.data}")
             flash('Un compte avec cet email existe déjà.', 'error')
             return render_template('register.html', form=form)
 
-        # Créer un nouveau utilisateur
+        # Créer un nouveau utilisateur (INSERT direct : l'objet User n'est pas réutilisé ensuite)
         hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
-        user = User(
-            email=email,
-            nom=bleach.clean(form.nom.data.strip()),
-            prenom=bleach.clean(form.prenom.data.strip()),
-            user_type=form.user_type.data,
-            password_hash=hashed_password
-        )
+        user_type = form.user_type.data
 
         try:
-            db.session.add(user)
+            db.session.execute(insert(User).values(
+                email=email,
+                nom=form.nom.data.strip(),
+                prenom=form.prenom.data.strip(),
+                user_type=user_type,
+                password_hash=hashed_password
+            ))
             db.session.commit()
 
-            app.logger.info(f"Nouvel utilisateur inscrit : {user.email} ({user.user_type})")
+            app.logger.info(f"Nouvel utilisateur inscrit : {email} ({user_type})")
 
             flash('Votre compte a été créé avec succès! Vous pouvez maintenant vous connecter.', 'success')
             return redirect(url_for('login'))
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"Erreur lors de l'inscription de l'utilisateur {user.email} : {e}")
+            app.logger.error(f"Erreur lors de l'inscription de l'utilisateur {email} : {e}")
             flash('Une erreur est survenue lors de la création du compte.', 'error')
 
     return render_template('register.html', form=form)
@@ -387,27 +690,26 @@ def login():
 
     form = LoginForm()
     if form.validate_on_submit():
-        email = bleach.clean(form.email.data.lower().strip())
+        email = form.email.data.lower().strip()
         password = form.password.data
 
         app.logger.info(f"Login attempt for email: {email}")
 
-        # 1) Recherche DN utilisateur dans LDAP
-        user_dn = ldap_find_user_dn(email)
+        # 1) Recherche DN utilisateur dans LDAP, puis 2) authentification avec DN + mot de passe
+        user_dn, authenticated, ldap_entry = ldap_login(email, password)
         if user_dn:
             app.logger.info(f"Utilisateur LDAP trouvé : {email} avec DN {user_dn}")
 
-            # 2) Tente d'authentifier en LDAP avec DN + mot de passe
-            if ldap_authenticate(user_dn, password):
+            if authenticated:
                 app.logger.info(f"Authentification LDAP réussie pour {email}")
 
                 # 3) Cherche utilisateur localement
-                user = User.query.filter_by(email=email).first()
+                user = get_user_by_email(email)
 
                 # 4) Si utilisateur local n'existe pas, crée-le avec données LDAP basiques
                 if not user:
                     app.logger.info(f"Utilisateur {email} absent en local, création...")
-                    ldap_info = ldap_get_user_info(user_dn)
+                    ldap_info = ldap_get_user_info(ldap_entry)
                     nom = ldap_info.get('nom', 'NomInconnu')
                     prenom = ldap_info.get('prenom', 'PrenomInconnu')
 
@@ -422,11 +724,13 @@ def login():
                         nom=nom,
                         prenom=prenom,
                         user_type=user_type,
-                        password_hash=bcrypt.generate_password_hash(secrets.token_urlsafe(16)).decode('utf-8')  # mdp random car on utilise LDAP
+                        password_hash=LDAP_PASSWORD_HASH  # pas de mot de passe local : on utilise LDAP
                     )
                     try:
                         db.session.add(user)
+                        # expire_on_commit=False : user reste chargé après le commit, sans SELECT pour relire son id
                         db.session.commit()
+                        g._current_user = user
                         app.logger.info(f"Utilisateur {email} créé en local avec succès en tant que {user_type}.")
                     except Exception as e:
                         db.session.rollback()
@@ -435,8 +739,7 @@ def login():
                         return render_template('login.html', form=form)
 
                 # 5) Connexion réussie : session etc
-                session.clear()
-                session['user_id'] = user.id
+                remember_user(user)
                 session.permanent = form.remember_me.data
                 flash(f'Bienvenue {user.prenom}!', 'success')
 
@@ -457,10 +760,9 @@ def login():
             app.logger.info(f"Utilisateur {email} non trouvé en LDAP, tentative auth base locale...")
 
             # Essaye auth locale si user existe dans BDD locale
-            user = User.query.filter_by(email=email).first()
-            if user and bcrypt.check_password_hash(user.password_hash, password):
-                session.clear()
-                session['user_id'] = user.id
+            user = get_user_by_email(email)
+            if user and is_local_password_hash(user.password_hash) and bcrypt.check_password_hash(user.password_hash, password):
+                remember_user(user)
                 session.permanent = form.remember_me.data
 
                 app.logger.info(f"Connexion réussie (base locale) : {email} ({user.user_type})")
@@ -484,10 +786,10 @@ def login():
 def logout():
     user = get_current_user()
     if user:
-        app.logger.info(f"Déconnexion de l'utilisateur : {user.email}")
+        app.logger.info(f"Déconnexion de l'utilisateur : {user_label(user)}")
     else:
         app.logger.info("Déconnexion d'une session anonyme ou expirée.")
-    session.clear()
+    reset_session()
     flash('Vous avez été déconnecté.', 'info')
     return redirect(url_for('home'))
 
@@ -502,12 +804,12 @@ def professeurs():
         return redirect(url_for('login'))
 
     if current_user.user_type not in ['professeur', 'admin']:
-        app.logger.warning(f"Utilisateur non autorisé ({current_user.email}) a tenté d'accéder à /professeurs.")
+        app.logger.warning(f"Utilisateur non autorisé ({user_label(current_user)}) a tenté d'accéder à /professeurs.")
         flash('Accès réservé aux professeurs et admins.', 'error')
         return redirect(url_for('home'))
 
-    app.logger.info(f"Page /professeurs visitée par : {current_user.email}")
-    return render_template('professeurs.html', current_user=current_user)
+    app.logger.info(f"Page /professeurs visitée par : {user_label(current_user)}")
+    return render_template('professeurs.html')
 
 
 @app.route('/etudiants')
@@ -520,34 +822,44 @@ def etudiants():
         return redirect(url_for('login'))
 
     if current_user.user_type not in ['etudiant', 'admin']:
-        app.logger.warning(f"Utilisateur non autorisé ({current_user.email}) a tenté d'accéder à /etudiants.")
+        app.logger.warning(f"Utilisateur non autorisé ({user_label(current_user)}) a tenté d'accéder à /etudiants.")
         flash('Accès réservé aux étudiants et admins.', 'error')
         return redirect(url_for('home'))
 
-    app.logger.info(f"Page /etudiants visitée par : {current_user.email}")
-    return render_template('etudiants.html', current_user=current_user)
+    app.logger.info(f"Page /etudiants visitée par : {user_label(current_user)}")
+    return render_template('etudiants.html')
 
 @app.route('/admin_dashboard')
 def admin_dashboard():
-    current_user = get_current_user()
+    current_user = get_current_user(fresh=True)  # rôle admin vérifié en base à chaque accès
 
     if not current_user or current_user.user_type != 'admin':
-        app.logger.warning(f"Accès non autorisé à /admin par {current_user.email if current_user else 'utilisateur non connecté'}")
+        app.logger.warning(f"Accès non autorisé à /admin par {user_label(current_user) if current_user else 'utilisateur non connecté'}")
         flash('Accès réservé aux administrateurs.', 'error')
         return redirect(url_for('home'))
 
-    return render_template('admin_dashboard.html', current_user=current_user)
+    return render_template('admin_dashboard.html')
 
 
-# Gestionnaire d'erreurs
-@app.errorhandler(404)
-def not_found_error(error):
-    return render_template('404.html'), 404
+def calibrate_bcrypt_rounds(target_ms=250):
+    """Mesure le coût du hachage bcrypt et indique le nombre de rounds adapté à ce serveur"""
+    rounds = app.config['BCRYPT_LOG_ROUNDS']
+    start = time.perf_counter()
+    bcrypt.generate_password_hash(b'x' * 16, rounds)
+    elapsed_ms = (time.perf_counter() - start) * 1000
 
-@app.errorhandler(500)
-def internal_error(error):
-    db.session.rollback()
-    return render_template('500.html'), 500
+    # Chaque round supplémentaire double le temps de calcul
+    suggested = rounds
+    while suggested > 4 and elapsed_ms * 2 ** (suggested - rounds) > target_ms:
+        suggested -= 1
+    while suggested < 31 and elapsed_ms * 2 ** (suggested + 1 - rounds) <= target_ms:
+        suggested += 1
+
+    app.logger.info(
+        f"bcrypt : {rounds} rounds = {elapsed_ms:.0f} ms par hachage, "
+        f"BCRYPT_LOG_ROUNDS={suggested} recommandé pour ~{target_ms} ms"
+    )
+    return suggested
 
 # Initialisation de la base de données
 def init_db():
@@ -555,6 +867,7 @@ def init_db():
         try:
             db.create_all()
             print("Base de données PostgreSQL initialisée avec succès !")
+            calibrate_bcrypt_rounds()
         except Exception as e:
             app.logger.error(f"Erreur lors de l'initialisation de la BDD : {e}")
             print(repr(e))  # <-- ajoute ceci
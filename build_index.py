@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Précalcule l'index de recherche des cours pour Smartpletude
+Le fichier instance/courses.idx.pkl est chargé au démarrage à la place de static/courses.json
+tant qu'il est plus récent que celui-ci : relancer ce script après chaque modification des cours
+"""
+
+import os
+import pickle
+
+from app import COURSES_INDEX_FILE, SEARCH_INDEX_VERSION, read_courses_file
+
+
+def build_index():
+    """Écrit les cours normalisés et l'index inversé dans le fichier pickle"""
+    courses, index = read_courses_file()
+
+    os.makedirs(os.path.dirname(COURSES_INDEX_FILE), exist_ok=True)
+    tmp_file = COURSES_INDEX_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump((SEARCH_INDEX_VERSION, courses, index), f, protocol=5)
+    # Remplacement atomique : un worker ne lit jamais un fichier à moitié écrit
+    os.replace(tmp_file, COURSES_INDEX_FILE)
+
+    print(f"✅ Index écrit dans {COURSES_INDEX_FILE} ({len(courses)} cours, {len(index['words'])} mots)")
+
+
+if __name__ == '__main__':
+    build_index()
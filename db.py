@@ -5,38 +5,36 @@ Ce script initialise la base de données et peut créer des utilisateurs de test
 """
 
 import sys
-from sqlalchemy import inspect
+import argparse
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from flask import has_app_context
+from sqlalchemy import func, insert, select, text
 from app import app, db, User, bcrypt
 import os
-from dotenv import load_dotenv
-from urllib.parse import quote_plus
+import mmap
+import re
 import secrets
 
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-
-load_dotenv()  # Charge .env
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+# .env est déjà chargé par app.py à son import
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or secrets.token_hex(32)  # clé aléatoire seulement si absente
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
 
 
-# Fix for potential encoding issues in DATABASE_URL
 def get_safe_database_url():
-    """Récupère l'URL de la base de données en gérant les problèmes d'encodage"""
-    try:
-        database_url = os.getenv("DATABASE_URL")
-        if database_url:
-            # Essayer de décoder et re-encoder proprement
-            return database_url.encode('utf-8').decode('utf-8')
-        return None
-    except UnicodeDecodeError:
-        print("❌ Erreur d'encodage dans DATABASE_URL")
-        print("💡 Essayez de recréer votre fichier .env avec l'encodage UTF-8")
-        return None
+    """Récupère l'URL de la base de données (None si absente ou vide)"""
+    # Les problèmes d'encodage du fichier .env sont signalés par check_environment
+    return os.environ.get("DATABASE_URL") or None
 
 SQLALCHEMY_DATABASE_URI = get_safe_database_url()
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+def app_context():
+    """Contexte applicatif pour une action : réutilise celui ouvert par main() s'il est actif"""
+    return nullcontext() if has_app_context() else app.app_context()
+
 def test_database_connection():
     """Test la connexion à la base de données"""
     print("Test de connexion à la base de données...")
@@ -46,10 +44,9 @@ def test_database_connection():
         return False
     
     try:
-        with app.app_context():
-            # Méthode alternative avec inspect
-            inspector = inspect(db.engine)
-            inspector.get_table_names()  # Ceci teste la connexion
+        with app_context():
+            # Un aller-retour minimal suffit à tester la connexion (pas de lecture du catalogue)
+            db.session.execute(text('SELECT 1')).scalar()
             print("✅ Connexion à la base de données réussie")
             return True
     except Exception as e:
@@ -70,52 +67,145 @@ def init_database():
         return False
 
     try:
-        with app.app_context():
+        with app_context():
             db.drop_all()
             print("Tables existantes supprimées")
 
             db.create_all()
             print("Tables créées avec succès")
 
-            tables = inspect(db.engine).get_table_names()
+            tables = list(db.metadata.tables.keys())  # tables des modèles, sans requête de réflexion
             print(f"Tables créées: {', '.join(tables)}")
             return True
     except Exception as e:
         print(f"❌ Erreur lors de l'initialisation: {e}")
         return False
 
-def create_test_users():
-    """Crée des utilisateurs de test"""
-    print("Création des utilisateurs de test...")
+# Coût bcrypt réduit pour les comptes de test : mots de passe connus, inutile de payer le coût de prod
+TEST_BCRYPT_ROUNDS = int(os.getenv('TEST_BCRYPT_ROUNDS', '4'))
+
+# Hachés précalculés (coût 4) de prof123 et etudiant123 : réutilisés tant que le coût n'est pas changé,
+# sauf si REHASH_TEST_USERS est défini
+_TEST_HASHES_ROUNDS = 4
+_PROF_HASH = '$2b$04$817tCLs3cmRitSySRdorTen872ha5JlUQHoQkuROflzQ3EMYZdriW'
+_ETUDIANT_HASH = '$2b$04$Ynopyqw2k3h27sKa7h2KoeRnK2CzMky9Q4nTefEuXzNJJUuTUegJi'
 
+# Nombre de lignes par INSERT multi-lignes lors d'un import d'utilisateurs
+SEED_BATCH_SIZE = 1000
+
+def seed_users(user_dicts, batch_size=SEED_BATCH_SIZE):
+    """Insère des utilisateurs (colonnes de User, mot de passe déjà haché) par lots, en une seule transaction"""
+    # INSERT Core plutôt que l'unit of work de l'ORM : pas d'objets User à suivre dans la session
     try:
-        with app.app_context():
-            prof_password = bcrypt.generate_password_hash('prof123').decode('utf-8')
-            prof = User(
-                email='prof@smartpletude.info',
-                nom='Dupont',
-                prenom='Marie',
-                user_type='professeur',
-                password_hash=prof_password
-            )
+        for start in range(0, len(user_dicts), batch_size):
+            db.session.execute(insert(User), user_dicts[start:start + batch_size])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+# Colonnes attendues dans un CSV d'import, dans cet ordre, après une ligne d'en-tête
+CSV_COLUMNS = ('email', 'nom', 'prenom', 'user_type', 'password_hash')
+
+def bulk_seed_from_csv(path):
+    """Importe des utilisateurs depuis un CSV (mots de passe déjà hachés, emails normalisés en minuscules).
+    Retourne le nombre d'utilisateurs importés"""
+    table = User.__tablename__
+    if db.engine.dialect.driver == 'psycopg2':
+        # COPY : les lignes sont transmises telles quelles, sans INSERT à analyser ligne par ligne
+        raw = db.engine.raw_connection()
+        try:
+            with raw.cursor() as cur, open(path, encoding='utf-8', newline='') as f:
+                cur.copy_expert(
+                    f'COPY "{table}" ({", ".join(CSV_COLUMNS)}) FROM STDIN WITH (FORMAT csv, HEADER true)', f
+                )
+                count = cur.rowcount
+                # created_at n'a pas de valeur par défaut côté base (default Python, ignoré par COPY)
+                cur.execute(f"""UPDATE "{table}" SET created_at = now() AT TIME ZONE 'utc' WHERE created_at IS NULL""")
+                # Ni COPY ni INSERT ne passent par User.normalize_email : même normalisation, en base
+                cur.execute(f'UPDATE "{table}" SET email = lower(btrim(email)) WHERE email <> lower(btrim(email))')
+            raw.commit()
+        except Exception:
+            raw.rollback()
+            raise
+        finally:
+            raw.close()
+        return count
+
+    # Autres bases : INSERT multi-lignes par lots
+    with open(path, encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)  # en-tête
+        rows = [dict(zip(CSV_COLUMNS, row)) for row in reader]
+    # L'INSERT Core ne passe pas par User.normalize_email
+    for row in rows:
+        row['email'] = row['email'].strip().lower()
+    seed_users(rows)
+    return len(rows)
 
-            etudiant_password = bcrypt.generate_password_hash('etudiant123').decode('utf-8')
-            etudiant = User(
-                email='etudiant@smartpletude.info',
-                nom='Martin',
-                prenom='Pierre',
-                user_type='etudiant',
-                password_hash=etudiant_password
+def import_users_csv(args):
+    """Importe les utilisateurs d'un fichier CSV"""
+    print(f"Import des utilisateurs depuis {args.path}...")
+
+    if not test_database_connection():
+        return False
+
+    try:
+        with app_context():
+            count = bulk_seed_from_csv(args.path)
+            print(f"✅ {count} utilisateur(s) importé(s)")
+            return True
+    except Exception as e:
+        print(f"❌ Erreur lors de l'import: {e}")
+        return False
+
+def test_user_rows():
+    """Lignes des utilisateurs de test, mots de passe hachés"""
+    if TEST_BCRYPT_ROUNDS == _TEST_HASHES_ROUNDS and not os.getenv('REHASH_TEST_USERS'):
+        prof_password, etudiant_password = _PROF_HASH, _ETUDIANT_HASH
+    else:
+        # bcrypt libère le GIL pendant le hachage : les deux mots de passe sont hachés en parallèle
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            prof_password, etudiant_password = (
+                h.decode('utf-8') for h in executor.map(
+                    lambda pw: bcrypt.generate_password_hash(pw, TEST_BCRYPT_ROUNDS),
+                    ['prof123', 'etudiant123']
+                )
             )
 
-            db.session.add_all([prof, etudiant])
-            db.session.commit()
-            print("✅ Utilisateurs de test créés avec succès")
-            print("   Professeur: prof@smartpletude.info / prof123")
-            print("   Étudiant: etudiant@smartpletude.info / etudiant123")
+    return [
+        {
+            'email': 'prof@smartpletude.info',
+            'nom': 'Dupont',
+            'prenom': 'Marie',
+            'user_type': 'professeur',
+            'password_hash': prof_password
+        },
+        {
+            'email': 'etudiant@smartpletude.info',
+            'nom': 'Martin',
+            'prenom': 'Pierre',
+            'user_type': 'etudiant',
+            'password_hash': etudiant_password
+        },
+    ]
+
+def print_test_users():
+    """Affiche les identifiants des utilisateurs de test"""
+    print("✅ Utilisateurs de test créés avec succès")
+    print("   Professeur: prof@smartpletude.info / prof123")
+    print("   Étudiant: etudiant@smartpletude.info / etudiant123")
+
+def create_test_users():
+    """Crée des utilisateurs de test"""
+    print("Création des utilisateurs de test...")
+
+    try:
+        with app_context():
+            seed_users(test_user_rows())
+            print_test_users()
             return True
     except Exception as e:
-        db.session.rollback()
         print(f"❌ Erreur lors de la création des utilisateurs: {e}")
         return False
 
@@ -124,60 +214,94 @@ def show_database_info():
     print("Informations sur la base de données:")
 
     if not test_database_connection():
-        return
+        return False
 
     try:
-        with app.app_context():
-            user_count = User.query.count()
-            prof_count = User.query.filter_by(user_type='professeur').count()
-            etudiant_count = User.query.filter_by(user_type='etudiant').count()
+        with app_context():
+            # Un seul parcours de la table : nombre d'utilisateurs par type
+            counts = dict(db.session.execute(
+                select(User.user_type, func.count()).group_by(User.user_type)
+            ).all())
+            user_count = sum(counts.values())
+            prof_count = counts.get('professeur', 0)
+            etudiant_count = counts.get('etudiant', 0)
 
             print(f"   Total utilisateurs: {user_count}")
             print(f"   Professeurs: {prof_count}")
             print(f"   Étudiants: {etudiant_count}")
 
-            users = User.query.all()
-            if users:
+            if user_count:
                 print("Liste des utilisateurs:")
-                for user in users:
-                    print(f"   - {user.email} ({user.user_type}) - {user.prenom} {user.nom}")
+                # Lecture par lots de 500 lignes, limitée aux colonnes affichées (pas d'objets User en mémoire)
+                users = db.session.execute(
+                    select(User.email, User.user_type, User.prenom, User.nom).execution_options(yield_per=500)
+                )
+                # Une écriture par lot plutôt qu'une par utilisateur
+                for batch in users.partitions():
+                    sys.stdout.write(''.join(
+                        f"   - {user.email} ({user.user_type}) - {user.prenom} {user.nom}\n" for user in batch
+                    ))
+                sys.stdout.flush()
+            return True
     except Exception as e:
         print(f"❌ Erreur lors de la récupération des informations: {e}")
+        return False
 
 def reset_database():
     """Remet à zéro complètement la base de données"""
     print("Remise à zéro complète de la base de données...")
 
-    if init_database():
-        create_test_users()
-    else:
+    if not test_database_connection():
         print("❌ Échec de la remise à zéro")
+        return False
+
+    try:
+        rows = test_user_rows()  # hachage avant d'ouvrir la transaction
+        # Suppression, création des tables et utilisateurs de test : une connexion, une transaction
+        with app_context(), db.engine.begin() as conn:
+            db.metadata.drop_all(conn)
+            db.metadata.create_all(conn)
+            conn.execute(insert(User), rows)
+        print(f"Tables recréées: {', '.join(db.metadata.tables.keys())}")
+        print_test_users()
+        return True
+    except Exception as e:
+        print(f"❌ Échec de la remise à zéro: {e}")
+        return False
 
-def delete_user_by_email():
-    """Supprime un utilisateur à partir de son email"""
+def delete_user_by_email(email=None, assume_yes=False):
+    """Supprime un utilisateur à partir de son email (demandé s'il n'est pas fourni)"""
     print("\n🗑️ Suppression d'un utilisateur")
     
     if not test_database_connection():
-        return
+        return False
         
-    email = input("Entrez l'email de l'utilisateur à supprimer: ").strip()
+    if email is None:
+        email = input("Entrez l'email de l'utilisateur à supprimer: ")
+    email = email.strip().lower()  # les emails sont stockés en minuscules
 
     try:
-        with app.app_context():
+        with app_context():
             user = User.query.filter_by(email=email).first()
             if user:
-                confirm = input(f"Confirmer la suppression de {user.prenom} {user.nom} ({user.email}) ? (oui/non): ").lower()
+                confirm = 'oui' if assume_yes else input(f"Confirmer la suppression de {user.prenom} {user.nom} ({user.email}) ? (oui/non): ").lower()
                 if confirm in ['oui', 'o', 'yes', 'y']:
                     db.session.delete(user)
                     db.session.commit()
                     print(f"✅ Utilisateur {email} supprimé avec succès.")
+                    return True
                 else:
                     print("❌ Suppression annulée.")
             else:
                 print(f"❌ Aucun utilisateur trouvé avec l'email: {email}")
+            return False
     except Exception as e:
         db.session.rollback()
         print(f"❌ Erreur lors de la suppression: {e}")
+        return False
+
+# Mot de passe d'une URL de connexion (jusqu'au dernier @) : masqué à l'affichage
+_URL_MASK = re.compile(r'^([^:/]+://[^:/@]*):.*@')
 
 def check_environment():
     """Vérifie la configuration de l'environnement"""
@@ -188,12 +312,17 @@ def check_environment():
     if os.path.exists(env_file):
         print(f"✅ Fichier {env_file} trouvé")
         try:
-            with open(env_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-                if 'DATABASE_URL' in content:
-                    print("✅ DATABASE_URL trouvée dans .env")
-                else:
-                    print("❌ DATABASE_URL non trouvée dans .env")
+            found = False
+            if os.path.getsize(env_file):  # mmap refuse les fichiers vides
+                with open(env_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    found = mm.find(b'DATABASE_URL') != -1
+            if found:
+                print("✅ DATABASE_URL trouvée dans .env")
+            else:
+                # Clé introuvable : peut-être un fichier mal encodé (UTF-16...), on le décode pour le savoir
+                with open(env_file, 'r', encoding='utf-8') as f:
+                    f.read()
+                print("❌ DATABASE_URL non trouvée dans .env")
         except UnicodeDecodeError:
             print("❌ Problème d'encodage dans le fichier .env")
             print("💡 Recréez le fichier .env avec l'encodage UTF-8")
@@ -205,24 +334,21 @@ def check_environment():
     if database_url:
         print("✅ DATABASE_URL chargée")
         # Masquer le mot de passe pour l'affichage
-        safe_url = database_url
-        if '@' in safe_url:
-            parts = safe_url.split('@')
-            if ':' in parts[0]:
-                user_pass = parts[0].split(':')
-                if len(user_pass) >= 2:
-                    safe_url = f"{user_pass[0]}:***@{parts[1]}"
+        safe_url = _URL_MASK.sub(r'\1:***@', database_url)
         print(f"   URL: {safe_url}")
     else:
         print("❌ DATABASE_URL non chargée")
 
-def main():
-    """Fonction principale avec menu interactif"""
+def interactive_menu():
+    """Menu interactif"""
     print("=" * 50)
     print("SMARTPLETUDE - Gestionnaire de Base de Données")
     print("=" * 50)
 
     while True:
+        # Termine la transaction laissée par l'action précédente : aucun verrou gardé pendant la saisie
+        db.session.close()
+
         print("\nQue souhaitez-vous faire?")
         print("1. Initialiser la base de données")
         print("2. Créer des utilisateurs de test")
@@ -259,5 +385,57 @@ def main():
         else:
             print("❌ Choix invalide, veuillez réessayer.")
 
+def confirm_reset(args):
+    """Remise à zéro, après confirmation sauf avec --yes"""
+    if not args.yes:
+        confirm = input("Êtes-vous sûr de vouloir tout supprimer ? (oui/non): ")
+        if confirm.lower() not in ['oui', 'o', 'yes', 'y']:
+            print("❌ Opération annulée")
+            return False
+    return reset_database()
+
+def main():
+    """Fonction principale : sous-commande en argument, menu interactif sinon (dans un terminal)"""
+    parser = argparse.ArgumentParser(description="SMARTPLETUDE - Gestionnaire de Base de Données")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('init', help="Initialiser la base de données (supprime les tables existantes)")
+    subparsers.add_parser('seed', help="Créer des utilisateurs de test")
+    subparsers.add_parser('info', help="Afficher les informations de la base")
+    reset_parser = subparsers.add_parser('reset', help="Remise à zéro complète (init + utilisateurs de test)")
+    reset_parser.add_argument('-y', '--yes', action='store_true', help="Ne pas demander de confirmation")
+    csv_parser = subparsers.add_parser('import-csv', help="Importer des utilisateurs depuis un CSV (" + ",".join(CSV_COLUMNS) + ")")
+    csv_parser.add_argument('path', help="Fichier CSV avec une ligne d'en-tête, mots de passe déjà hachés")
+    delete_parser = subparsers.add_parser('delete', help="Supprimer un utilisateur par email")
+    delete_parser.add_argument('--email', required=True, help="Email de l'utilisateur à supprimer")
+    delete_parser.add_argument('-y', '--yes', action='store_true', help="Ne pas demander de confirmation")
+    subparsers.add_parser('check', help="Vérifier l'environnement")
+    subparsers.add_parser('ping', help="Tester la connexion à la base")
+    args = parser.parse_args()
+
+    commands = {
+        'init': lambda args: init_database(),
+        'seed': lambda args: create_test_users(),
+        'info': lambda args: show_database_info(),
+        'reset': confirm_reset,
+        'import-csv': import_users_csv,
+        'delete': lambda args: delete_user_by_email(args.email, args.yes),
+        'check': lambda args: check_environment(),
+        'ping': lambda args: test_database_connection(),
+    }
+
+    if args.command is None and not sys.stdin.isatty():
+        # Sans terminal (CI, conteneur), pas de menu à attendre : on affiche l'aide
+        parser.print_help()
+        sys.exit(2)
+
+    # Un seul contexte applicatif (et une seule session) pour toute l'exécution
+    with app.app_context():
+        if args.command is None:
+            interactive_menu()
+            return
+        succeeded = commands[args.command](args) is not False
+    if not succeeded:
+        sys.exit(1)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,12 @@
+"""
+Configuration gunicorn pour Smartpletude (chargée automatiquement par `gunicorn app:app`)
+Workers à threads : bcrypt et ldap3 libèrent le GIL, les autres requêtes ne sont pas bloquées
+"""
+
+import multiprocessing
+import os
+
+# Pas de bind ici : adresse par défaut de gunicorn (127.0.0.1:8000, ou 0.0.0.0:$PORT si PORT est défini) ou option -b
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))